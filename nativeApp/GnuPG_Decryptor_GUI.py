@@ -3,7 +3,9 @@ This module implements GUI for GnuPG_Decryptor broswer extension
 """
 from os import getcwd
 from PyQt5.QtWidgets import QWidget, QLabel, QBoxLayout, QLineEdit, QCheckBox, QPushButton, QDesktopWidget, QFileDialog
-from PyQt5.QtGui import QIcon, QFont
+from PyQt5.QtWidgets import QApplication, QListView, QAbstractItemView, QStyledItemDelegate, QStyleOptionViewItem, QStyle
+from PyQt5.QtGui import QIcon, QFont, QPalette
+from PyQt5.QtCore import Qt, QAbstractListModel, QSortFilterProxyModel, QModelIndex, QRect, QSize, QThread, pyqtSignal
 
 class GnuPG_Decryptor_GUI( QWidget ):
     """
@@ -14,6 +16,8 @@ class GnuPG_Decryptor_GUI( QWidget ):
         self._backend = app
         self._sudo    = sudo
         self._homedir = homedir
+        self._worker  = None
+        self._refreshSettings = ( None, None )
         self.initUI( initKeys )
 
     def resizeEvent( self, _ ):
@@ -22,6 +26,22 @@ class GnuPG_Decryptor_GUI( QWidget ):
         """
         self._keyList.setMaximumSize( self.width(), self.height() * 0.66 )
 
+    def closeEvent( self, event ):
+        """
+        Abandons running refresh before window is closed
+        """
+        if ( self._worker is not None ):
+            # keys of unfinished refresh must not reach reopened window,
+            # worker is deleted when gpg finishes, UI is not blocked
+            self._worker.keysReset.disconnect()
+            self._worker.keysFound.disconnect()
+            self._worker.refreshFinished.disconnect()
+            self._worker.finished.connect( self._worker.deleteLater )
+            self._worker = None
+            self._refresher.setRefreshing( False )
+            self._keyList.setRefreshing( False )
+        super().closeEvent( event )
+
     def initUI( self, initKeys ):
         """
         Inits UI (icon, minimum size, widgets, etc)
@@ -55,19 +75,61 @@ class GnuPG_Decryptor_GUI( QWidget ):
         Notifies backend about actions
         """
         if ( message[ 'action' ] == 'refresh' ):
-            # refreshes keys
-            data = self._backend.keyList( message )
-            # if success, display new keys
-            if ( data[ 'returnCode' ] == 0 ):
-                sudo = message['sudo']['password']    if message[ 'sudo' ][ 'use' ] else None
-                home = message['home']['homedir'] if message[ 'home' ][ 'use' ] else None
-                self._keyList.newKeys( data[ 'keys' ], sudo, home )
+            # only one refresh at time
+            if ( self._worker is not None ):
+                return
+            # refreshes keys in background, new keys are displayed as they come
+            sudo = message['sudo']['password']    if message[ 'sudo' ][ 'use' ] else None
+            home = message['home']['homedir'] if message[ 'home' ][ 'use' ] else None
+            self._refreshSettings = ( sudo, home )
+            self._worker = KeyListWorker( self._backend, message, self )
+            self._worker.keysReset.connect( self.keysReset )
+            self._worker.keysFound.connect( self.keysFound )
+            self._worker.refreshFinished.connect( self.refreshFinished )
+            self._refresher.setRefreshing( True )
+            self._keyList.setRefreshing( True )
+            self._worker.start()
         elif ( message[ 'action' ] == 'confirm' ):
             # confirm changes and closes window
             self._backend.debug( str( message ) )
             self._backend.setPasswords( message )
             self.close()
 
+    def keysReset( self ):
+        """
+        Clears key list when refresh succeeded
+        """
+        # ignore events queued by refresh that was already stopped
+        if ( self.sender() is self._worker ):
+            self._keyList.resetKeys( *self._refreshSettings )
+
+    def keysFound( self, keys ):
+        """
+        Displays batch of refreshed keys
+        """
+        if ( self.sender() is self._worker ):
+            self._keyList.appendKeys( keys )
+
+    def refreshFinished( self, returnCode ):
+        """
+        Cleans up after background refresh
+        """
+        if ( self.sender() is not self._worker ):
+            return
+        self.stopRefresh()
+        if ( returnCode != 0 ):
+            self._backend.debug( 'Unable to list keys, return code ' + str( returnCode ) )
+
+    def stopRefresh( self ):
+        """
+        Waits for background refresh and enables buttons again
+        """
+        self._worker.wait()
+        self._worker.deleteLater()
+        self._worker = None
+        self._refresher.setRefreshing( False )
+        self._keyList.setRefreshing( False )
+
 class KeyList( QWidget ):
     """
     Displaya list of available keys for user.
@@ -75,7 +137,7 @@ class KeyList( QWidget ):
     def __init__( self, parent, initKeys, sudo, homedir ):
         super().__init__( parent )
         self._parent  = parent
-        self._keys    = []
+        self._model   = KeyListModel( self )
         self._sudo    = sudo
         self._homedir = homedir
         self.initUI()
@@ -90,22 +152,47 @@ class KeyList( QWidget ):
         font.setBold( True )
         header = QLabel( 'Available Keys', self )
         header.setFont( font )
-        header.setMaximumHeight( KeyItem.itemHeight() )
+        header.setMaximumHeight( KeyItemDelegate.itemHeight() )
         self._layout = QBoxLayout( QBoxLayout.TopToBottom, parent = self )
         self._layout.setSpacing(5)
         self._layout.setContentsMargins(0,0,0,0)
         self.setLayout( self._layout )
         self._layout.addWidget( header )
 
+        # filter keys by uid, case insensitive
+        self._proxy = QSortFilterProxyModel( self )
+        self._proxy.setSourceModel( self._model )
+        self._proxy.setFilterCaseSensitivity( Qt.CaseInsensitive )
+        self._filter = QLineEdit( self )
+        self._filter.setPlaceholderText( 'Filter keys' )
+        self._filter.setMaximumWidth( sum( KeyItemDelegate.itemWidths() ) )
+        self._filter.textChanged.connect( self._proxy.setFilterFixedString )
+
+        # view renders only visible rows, passwords are edited in place
+        self._view = QListView( self )
+        self._view.setModel( self._proxy )
+        self._view.setItemDelegate( KeyItemDelegate( self._view ) )
+        self._view.setUniformItemSizes( True )
+        self._view.setSelectionMode( QAbstractItemView.SingleSelection )
+        self._view.setEditTriggers( QAbstractItemView.AllEditTriggers )
+
         self._button = QPushButton( "Confirm" )
         self._button.setMaximumWidth( 80 )
         self._button.clicked.connect( self.confirm )
         self._noKeys = QLabel( 'No keys found.' )
 
+        self._layout.addWidget( self._filter )
+        self._layout.addWidget( self._view )
         self._layout.addWidget( self._noKeys )
         self._layout.addWidget( self._button )
-        self._layout.addStretch( 1 )
 
+    def setRefreshing( self, refreshing ):
+        """
+        Disables confirm button while keys are being refreshed, so only complete
+        list of keys can be confirmed.
+        """
+
+        self._button.setEnabled( not refreshing )
 
     def confirm( self ):
         """
@@ -113,8 +200,8 @@ class KeyList( QWidget ):
         """
 
         keys = list()
-        for key in self._keys:
-            keys.append( { 'id' : key.getId(), 'password' : key.getPass() } )
+        for key in self._model.keys():
+            keys.append( { 'id' : key[ 'id' ], 'password' : key[ 'password' ] } )
 
         useSudo = 0 if self._sudo    is None else 1
         useHome = 0 if self._homedir is None else 1
@@ -128,38 +215,116 @@ class KeyList( QWidget ):
         Displays new keys fo user
         """
 
+        self.resetKeys( sudo, homedir )
+        self.appendKeys( keys )
+
+    def resetKeys( self, sudo = None, homedir = None ):
+        """
+        Deletes all keys and sets new sudo and homedir settings
+        """
+
         self._sudo    = sudo
         self._homedir = homedir
         self.clearList()
-        if ( keys ):
-            self._noKeys.hide()
-            for key in keys:
-                self.newKey( key )
-        else:
-            self._noKeys.show()
+
+    def appendKeys( self, keys ):
+        """
+        Adds new keys at the end of list
+        """
+
+        self._model.appendKeys( keys )
+        self._noKeys.setVisible( self._model.rowCount() == 0 )
 
     def clearList( self ):
         """
         Deletes all items
         """
 
-        for item in self._keys:
-            self._layout.removeWidget( item )
-            item.deleteLater()
+        self._model.clear()
+        self._noKeys.show()
+
+class KeyListModel( QAbstractListModel ):
+    """
+    Model holding uids of keys and their passwords.
+    """
+    def __init__( self, parent = None ):
+        super().__init__( parent )
         self._keys = []
 
-    def newKey( self, key ):
+    def rowCount( self, parent = QModelIndex() ):
+        """
+        Returns number of keys
+        """
+
+        if ( parent.isValid() ):
+            return 0
+        return len( self._keys )
+
+    def data( self, index, role = Qt.DisplayRole ):
+        """
+        Returns uid (display role) or password (edit role) of key
+        """
+
+        if ( not index.isValid() or index.row() >= len( self._keys ) ):
+            return None
+        key = self._keys[ index.row() ]
+        if ( role == Qt.DisplayRole ):
+            return key[ 'id' ]
+        elif ( role == Qt.EditRole ):
+            return key[ 'password' ]
+        return None
+
+    def setData( self, index, value, role = Qt.EditRole ):
+        """
+        Sets password of key
+        """
+
+        if ( not index.isValid() or role != Qt.EditRole ):
+            return False
+        self._keys[ index.row() ][ 'password' ] = value
+        self.dataChanged.emit( index, index, [ role ] )
+        return True
+
+    def flags( self, index ):
+        """
+        Keys are editable (password can be changed)
+        """
+
+        if ( not index.isValid() ):
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def appendKeys( self, keys ):
+        """
+        Adds new keys at the end of model
+        """
+
+        if ( not keys ):
+            return
+        first = len( self._keys )
+        self.beginInsertRows( QModelIndex(), first, first + len( keys ) - 1 )
+        self._keys.extend( { 'id' : key[ 'id' ], 'password' : key[ 'password' ] } for key in keys )
+        self.endInsertRows()
+
+    def clear( self ):
         """
-        Adds new key into list
+        Deletes all keys
         """
 
-        item = KeyItem( key, self )
-        self._layout.insertWidget( self._layout.count() - 2, item )
-        self._keys.append( item )
+        self.beginResetModel()
+        self._keys = []
+        self.endResetModel()
+
+    def keys( self ):
+        """
+        Returns list of all keys (including filtered out ones)
+        """
+        return self._keys
 
-class KeyItem( QWidget ):
+class KeyItemDelegate( QStyledItemDelegate ):
     """
-    Grafic representation of one key.
+    Grafic representation of one key. Paints uid and masked password, creates
+    password editor only for the row being edited.
     """
     @staticmethod
     def itemHeight():
@@ -177,46 +342,133 @@ class KeyItem( QWidget ):
 
         return [ 420, 300 ]
 
-    def __init__( self, key, parent ):
-        super().__init__( parent )
-        self._parent = parent
-        self._id = key[ 'id' ]
-        self.initUI( key[ 'password' ] )
-
-    def initUI( self, password ):
-        """
-        Inits UI (size, font, widgets, etc.)
-        """
-
-        self.setMinimumHeight( KeyItem.itemHeight() )
-        self.setMaximumHeight( KeyItem.itemHeight() )
-        self._labelId        = QLabel( self._id, self )
-        self._labelPassText  = QLabel( 'Password: ', self )
-        self._labelPass      = QLineEdit( self )
-        self._layout         = QBoxLayout( QBoxLayout.LeftToRight, parent = self )
-        self._labelPass.setEchoMode( QLineEdit.Password )
-        self._labelPass.setText( password )
-        widths = KeyItem.itemWidths()
-        self._labelId.setMaximumWidth( widths[0] )
-        self._labelId.setMinimumWidth( widths[0] )
-        self._layout.addWidget( self._labelId  )
-        self._layout.addWidget( self._labelPassText  )
-        self._layout.addWidget( self._labelPass  )
-        self._layout.addStretch( 1  )
-        self._layout.setContentsMargins( 10, 0, 0, 0 )
-        self.setLayout( self._layout )
+    @staticmethod
+    def passwordText():
+        """
+        Returns label displayed in front of password
+        """
+
+        return 'Password: '
+
+    def sizeHint( self, option, index ):
+        """
+        Returns size of item
+        """
+
+        return QSize( sum( KeyItemDelegate.itemWidths() ), KeyItemDelegate.itemHeight() )
 
-    def getPass( self ):
+    def _rects( self, option ):
         """
-        Returns password
+        Returns rectangles of uid, password label and password field
         """
-        return self._labelPass.text()
 
-    def getId( self ):
+        rect   = option.rect
+        widths = KeyItemDelegate.itemWidths()
+        label  = option.fontMetrics.width( KeyItemDelegate.passwordText() )
+        idRect    = QRect( rect.x() + 10, rect.y(), widths[0], rect.height() )
+        labelRect = QRect( idRect.right() + 1, rect.y(), label, rect.height() )
+        passRect  = QRect( labelRect.right() + 1, rect.y(), widths[1] - label, rect.height() )
+        return idRect, labelRect, passRect
+
+    def paint( self, painter, option, index ):
         """
-        Returns uid of key
+        Paints uid of key, password label and masked password
         """
-        return self._id
+
+        # draw background (selection, focus) without text
+        opt = QStyleOptionViewItem( option )
+        self.initStyleOption( opt, index )
+        opt.text = ''
+        style = opt.widget.style() if opt.widget else QApplication.style()
+        style.drawControl( QStyle.CE_ItemViewItem, opt, painter, opt.widget )
+
+        idRect, labelRect, passRect = self._rects( option )
+        uid      = index.data( Qt.DisplayRole ) or ''
+        password = index.data( Qt.EditRole ) or ''
+        selected = option.state & QStyle.State_Selected
+        painter.save()
+        painter.setPen( option.palette.color( QPalette.HighlightedText if selected else QPalette.Text ) )
+        painter.drawText( idRect, Qt.AlignVCenter | Qt.AlignLeft, option.fontMetrics.elidedText( uid, Qt.ElideRight, idRect.width() ) )
+        painter.drawText( labelRect, Qt.AlignVCenter | Qt.AlignLeft, KeyItemDelegate.passwordText() )
+        painter.drawText( passRect, Qt.AlignVCenter | Qt.AlignLeft, '●' * len( password ) )
+        painter.restore()
+
+    def createEditor( self, parent, option, index ):
+        """
+        Creates password field for edited key
+        """
+
+        editor = QLineEdit( parent )
+        editor.setEchoMode( QLineEdit.Password )
+        # store password into model with every change, so confirm never misses it
+        editor.textEdited.connect( lambda: self.commitData.emit( editor ) )
+        return editor
+
+    def setEditorData( self, editor, index ):
+        """
+        Loads password from model into editor
+        """
+        password = index.data( Qt.EditRole ) or ''
+        # model is updated with every keystroke, setting the same text again
+        # would move cursor to the end
+        if ( editor.text() != password ):
+            editor.setText( password )
+
+    def setModelData( self, editor, model, index ):
+        """
+        Stores password from editor into model
+        """
+        model.setData( index, editor.text(), Qt.EditRole )
+
+    def updateEditorGeometry( self, editor, option, index ):
+        """
+        Places editor over password field
+        """
+        editor.setGeometry( self._rects( option )[2] )
+
+class KeyListWorker( QThread ):
+    """
+    Lists keys in background thread and sends them to UI in batches.
+    """
+    keysReset       = pyqtSignal()
+    keysFound       = pyqtSignal( list )
+    refreshFinished = pyqtSignal( int )
+
+    BATCH_SIZE = 200
+
+    def __init__( self, backend, settings, parent = None ):
+        super().__init__( parent )
+        self._backend  = backend
+        self._settings = settings
+
+    def run( self ):
+        """
+        Calls gpg and emits found keys while gpg is still listing them
+        """
+
+        process = self._backend.keyListProcess( self._settings )
+        reset   = False
+        batch   = []
+        for line in process.stdout:
+            key = self._backend.parseKeyLine( line.decode() )
+            if ( key is None ):
+                continue
+            # gpg lists keys, replace keys displayed to user
+            if ( not reset ):
+                self.keysReset.emit()
+                reset = True
+            batch.append( key )
+            if ( len( batch ) >= KeyListWorker.BATCH_SIZE ):
+                self.keysFound.emit( batch )
+                batch = []
+        returnCode = process.wait()
+
+        # success without any key, display empty list
+        if ( returnCode == 0 and not reset ):
+            self.keysReset.emit()
+        if ( batch ):
+            self.keysFound.emit( batch )
+        self.refreshFinished.emit( returnCode )
 
 class Refresher( QWidget ):
     """
@@ -287,9 +539,9 @@ class Refresher( QWidget ):
             self._sudo.setText( sudo )
             self._sudoChck.setChecked( True )
 
-        button = QPushButton( "Refresh" )
-        button.setMaximumWidth( 80 )
-        button.clicked.connect( self.refresh )
+        self._button = QPushButton( "Refresh" )
+        self._button.setMaximumWidth( 80 )
+        self._button.clicked.connect( self.refresh )
 
         layout = QBoxLayout( QBoxLayout.TopToBottom, parent = self )
         layout.setSpacing(5)
@@ -300,7 +552,7 @@ class Refresher( QWidget ):
         layout.addWidget( self._homeChck )
         layout.addWidget( self._sudoWidget )
         layout.addWidget( self._homeWidget )
-        layout.addWidget( button )
+        layout.addWidget( self._button )
         layout.addStretch( 1 )
 
     def refresh( self ):
@@ -319,6 +571,13 @@ class Refresher( QWidget ):
         }
         self._parent.notifyBackend( message )
 
+    def setRefreshing( self, refreshing ):
+        """
+        Disables refresh button while keys are being refreshed.
+        """
+
+        self._button.setEnabled( not refreshing )
+
     def selectDir( self ):
         """
         Displays dialogue to selecet directory.
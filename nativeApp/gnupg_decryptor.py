@@ -9,30 +9,108 @@ Description: This module is native application of GnuPG_Decryptor broswer extens
 # than text, mode.
 
 import sys
+import os
 from json import loads, dumps
-from struct import pack, unpack
+from struct import pack, unpack, calcsize
+from stat import S_ISDIR
 from base64 import b64encode, b64decode
-from subprocess import Popen, PIPE
+from hashlib import sha256
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from socket import socket, timeout, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_PEERCRED
+from fcntl import flock, LOCK_EX, LOCK_NB
+from time import sleep, monotonic
+from traceback import print_exception
 from PyQt5.QtWidgets import QApplication
 from magic import Magic
 from GnuPG_Decryptor_GUI import GnuPG_Decryptor_GUI
 
+class GnuPG_Decryptor_Engine:
+    """
+    Resources shared by all clients of native application - cache of key UIDs,
+    mime type resolver and pool of decryption workers.
+    """
+    # Grace period of terminated gpg, then it is killed
+    TERMINATE_TIMEOUT = 5
+
+    def __init__( self, maxWorkers = None, decryptTimeout = None ):
+        """
+        Without maxWorkers every decryption runs in its own thread, otherwise
+        in pool of maxWorkers threads. With decryptTimeout, gpg decryption is
+        stopped after decryptTimeout seconds.
+        """
+        self._uids         = dict()
+        self._uidsLock     = Lock()
+        self._mimeResolver = Magic( mime=True )
+        self._mimeLock     = Lock()
+        self._pool         = ThreadPoolExecutor( max_workers = maxWorkers ) if maxWorkers else None
+        self.decryptTimeout = decryptTimeout
+
+    def getUid( self, homedir, keyId ):
+        """
+        Returns cached UID of key or None if it is not known
+        """
+        with self._uidsLock:
+            return self._uids.get( ( homedir, keyId ) )
+
+    def setUid( self, homedir, keyId, uid ):
+        """
+        Stores UID of key into cache
+        """
+        with self._uidsLock:
+            self._uids[ ( homedir, keyId ) ] = uid
+
+    def mimeType( self, data ):
+        """
+        Returns mime type of data
+        """
+        # libmagic handle is not thread safe
+        with self._mimeLock:
+            return self._mimeResolver.from_buffer( data )
+
+    def submit( self, function, *args ):
+        """
+        Runs function in worker pool or in new thread
+        """
+        if ( self._pool is None ):
+            Thread( target = function, args = args ).start()
+            return None
+        future = self._pool.submit( function, *args )
+        future.add_done_callback( GnuPG_Decryptor_Engine.logException )
+        return future
+
+    @staticmethod
+    def logException( future ):
+        """
+        Prints exception raised by function in worker pool to stderr
+        """
+        error = future.exception()
+        if ( error is not None ):
+            print_exception( type( error ), error, error.__traceback__ )
+
 class GnuPG_Decryptor:
     """
     Class representing Native application of GnuPG_Decryptor broswer extension.
     Native application is responsible for accessing private keys and decrypting
     content of a web page.
     """
-    def __init__( self ):
+    def __init__( self, inStream = None, outStream = None, engine = None ):
         self._passwords = dict()
         self._gui       = None
         self._QApp      = None
         self._sudo      = None
         self._homedir   = None
         self.MAX_MESSAGE_SIZE = 750 * 1024
-        self.mimeResolver     = Magic( mime=True )
+        self._input     = inStream  if inStream  is not None else sys.stdin.buffer
+        self._output    = outStream if outStream is not None else sys.stdout.buffer
+        self._engine    = engine
         self._lock      = Lock()
+        self._inFlight  = dict()
+        self._largeRequests = dict()
+        # changed with every change of keys, decryption with older keys can not be joined
+        self._keysGeneration = 0
+        self._inFlightLock = Lock()
 
     def show( self ):
         """
@@ -56,6 +134,53 @@ class GnuPG_Decryptor:
         Method returns list of secret keys based on sudo and homedir settings
         """
 
+        args, stdin = GnuPG_Decryptor.keyListArgs( settings )
+
+        # call subprocess
+        process = Popen( args ,stdin=PIPE, stdout=PIPE, stderr=PIPE )
+        stdout, _ = process.communicate( stdin.encode() )
+        retcode = process.returncode
+        ids    = []
+
+        # if success
+        if ( retcode == 0 ):
+            stdout = stdout.decode().splitlines()
+            ids    = [ GnuPG_Decryptor.parseKeyLine( line ) for line in stdout if line.startswith( 'uid' ) ]
+        return { 'returnCode' : retcode, 'keys' : ids }
+
+    def keyListProcess( self, settings ):
+        """
+        Method starts listing of secret keys, output can be read line by line
+        from stdout of returned process
+        """
+
+        args, stdin = GnuPG_Decryptor.keyListArgs( settings )
+
+        # stderr is not read, it must not fill up pipe
+        process = Popen( args ,stdin=PIPE, stdout=PIPE, stderr=DEVNULL )
+        try:
+            process.stdin.write( stdin.encode() )
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return process
+
+    @staticmethod
+    def parseKeyLine( line ):
+        """
+        Method returns key from line of gpg output or None if line does not contain uid
+        """
+
+        if ( not line.startswith( 'uid' ) ):
+            return None
+        return { 'id' : line[25:].strip(), 'password' : '' }
+
+    @staticmethod
+    def keyListArgs( settings ):
+        """
+        Method returns arguments and stdin of gpg call listing secret keys
+        """
+
         stdin = ''
         args  = []
         # use sudo
@@ -77,25 +202,25 @@ class GnuPG_Decryptor:
 
         # command to list secret keys
         args.append( '--list-secret-keys' )
-
-        # call subprocess
-        process = Popen( args ,stdin=PIPE, stdout=PIPE, stderr=PIPE )
-        stdout, _ = process.communicate( stdin.encode() )
-        retcode = process.returncode
-        ids    = []
-
-        # if success
-        if ( retcode == 0 ):
-            stdout = stdout.decode().splitlines()
-            ids    = [ { 'id' : line[25:].strip(), 'password' : '' } for line in stdout if line.startswith( 'uid' ) ]
-        return { 'returnCode' : retcode, 'keys' : ids }
+        return args, stdin
 
     def setPasswords( self, config ):
         """
         Method sets new keys and passwords.
         """
 
+        self.loadPasswords( config )
+
+        # notify background script about changes
+        self.updateKeys()
+
+    def loadPasswords( self, config ):
+        """
+        Method parses keys, passwords, sudo and homedir settings confirmed by user.
+        """
+
         # clear current keys and passwords
+        self._keysGeneration += 1
         self._passwords = dict()
 
         # set new keys and password
@@ -114,20 +239,22 @@ class GnuPG_Decryptor:
         else:
             self._homedir = None
 
-        # notify background script about changes
-        self.updateKeys()
-
-    def getKeyUidFromId( self, keyId ):
+    def getKeyUidFromId( self, keyId, homedir ):
         """
         From key id (or fingerprint if you prefer) generates get UID using gpg application
         """
 
+        # UID might be already known
+        uid = self._engine.getUid( homedir, keyId )
+        if ( not uid is None ):
+            return uid
+
         args      = [ 'gpg' ]
 
         # if homedir parameter should be used
-        if ( not self._homedir is None ):
+        if ( not homedir is None ):
             args.append( '--homedir' )
-            args.append( self._homedir )
+            args.append( homedir )
 
         # add gpg argumnets
         args.append( '--list-public-keys' )
@@ -146,9 +273,10 @@ class GnuPG_Decryptor:
             uids    = [ line[25:].strip() for line in stdout if line.startswith( 'uid' ) ]
             if ( uids ):
                 uid = uids[0]
+                self._engine.setUid( homedir, keyId, uid )
         return uid
 
-    def getKeyUidFromData( self, data ):
+    def getKeyUidFromData( self, data, homedir ):
         """
         Method finds out, which keys were used for data encryption.
         """
@@ -175,23 +303,32 @@ class GnuPG_Decryptor:
                 if ( idx2 == -1 ):
                     idx2 = len( line )
                 # get uid from id/fingerprint
-                uid = self.getKeyUidFromId( line[ idx1 : idx2 ] )
+                uid = self.getKeyUidFromId( line[ idx1 : idx2 ], homedir )
                 if ( not uid is None ):
                     keys.append( uid )
         return keys
 
     @staticmethod
-    def get_message():
+    def read_frame( stream ):
         """
-        Reads message from background script
+        Reads one encoded message from stream, returns None at the end of stream
         """
-        raw_length = sys.stdin.buffer.read( 4 )
+        raw_length = stream.read( 4 )
 
-        if not raw_length:
-            sys.exit( 0 )
+        if len( raw_length ) < 4:
+            return None
         message_length = unpack( '=I', raw_length )[0]
-        message = sys.stdin.buffer.read( message_length ).decode( "utf-8" )
-        return loads( message )
+        return stream.read( message_length )
+
+    def get_message( self ):
+        """
+        Reads message from background script, returns None when connection is closed
+        """
+        message = GnuPG_Decryptor.read_frame( self._input )
+
+        if message is None:
+            return None
+        return loads( message.decode( "utf-8" ) )
 
 
     @staticmethod
@@ -210,9 +347,9 @@ class GnuPG_Decryptor:
         Sends an encoded message to background script.
         """
         with self._lock:
-            sys.stdout.buffer.write( encoded_message[ 'length' ] )
-            sys.stdout.buffer.write( encoded_message[ 'content' ] )
-            sys.stdout.buffer.flush()
+            self._output.write( encoded_message[ 'length' ] )
+            self._output.write( encoded_message[ 'content' ] )
+            self._output.flush()
 
     def debug( self, messageString ):
         """
@@ -244,30 +381,93 @@ class GnuPG_Decryptor:
 
         self.send_message( GnuPG_Decryptor.encode_message( message ) )
 
-    def decrypt( self, rawData, keys, messageId, tabId ):
+    def decryptRequest( self, rawData, messageId, tabId ):
+        """
+        Starts decryption of data, or attaches to decryption of identical data
+        that is already running.
+        """
+        # result depends on data and on keys used for decryption
+        flightKey = ( sha256( rawData ).digest(), self._keysGeneration )
+        settings  = { 'passwords' : self._passwords, 'homedir' : self._homedir, 'sudo' : self._sudo }
+        with self._inFlightLock:
+            # same data are already being decrypted, wait for the result
+            if ( flightKey in self._inFlight ):
+                self._inFlight[ flightKey ].append( ( messageId, tabId ) )
+                return
+            self._inFlight[ flightKey ] = [ ( messageId, tabId ) ]
+        self._engine.submit( self.decrypt, rawData, flightKey, settings )
+
+    def sendDecryptResponse( self, flightKey, responses ):
+        """
+        Sends responses to every request waiting for decryption with given in-flight key.
+        """
+
+        # no new request can attach once waiters are taken
+        with self._inFlightLock:
+            waiters = self._inFlight.pop( flightKey )
+
+        for messageId, tabId in waiters:
+            for response in responses:
+                response[ 'messageId' ] = messageId
+                response[ 'tabId' ]     = tabId
+                self.send_message( GnuPG_Decryptor.encode_message( response ) )
+
+    @staticmethod
+    def errorResponse( errorMessage ):
+        """
+        Returns response informing about failed decryption.
+        """
+        return { 'messageId' : None, 'success' : 0, 'message' : 'Unable to decrypt data: ' + errorMessage, 'type' : 'decryptResponse', 'data' : '', 'tabId' : None }
+
+    def decrypt( self, rawData, flightKey, settings ):
         """
-        Decrypts the data and sends decrypted content to the content script.
+        Decrypts the data and sends decrypted content to the content scripts.
         """
+        responses = [ GnuPG_Decryptor.errorResponse( 'Decryption was interrupted' ) ]
+        try:
+            responses = self.decryptData( rawData, settings )
+        except Exception as error:
+            responses = [ GnuPG_Decryptor.errorResponse( str( error ) ) ]
+            raise
+        finally:
+            # waiting requests are always answered and released
+            self.sendDecryptResponse( flightKey, responses )
+
+    def decryptData( self, rawData, settings ):
+        """
+        Decrypts the data using keys, sudo and homedir settings taken when
+        decryption was requested, and returns responses for the content scripts.
+        """
+        passwords = settings[ 'passwords' ]
+        homedir   = settings[ 'homedir' ]
+        sudo      = settings[ 'sudo' ]
+
+        # get key, that was used for encryption
+        keys = self.getKeyUidFromData( rawData, homedir )
+
+        # use only keys that are available
+        keys = [ key for key in keys if key in passwords ]
+
         err     = b''
         retcode = 0
         for key in keys:
             args     = []
             sudoPass = ''
-            keyPass  = self._passwords[ key ]
+            keyPass  = passwords[ key ]
 
             # if sudo should be used
-            if ( not self._sudo is None ):
+            if ( not sudo is None ):
                 args.append( 'sudo' )
                 args.append( '-Sk' )
-                sudoPass = self._sudo + '\n'
+                sudoPass = sudo + '\n'
 
             # gpp argument
             args.append( 'gpg' )
 
             # if homedir should be used
-            if ( not self._homedir is None ):
+            if ( not homedir is None ):
                 args.append( '--homedir' )
-                args.append( self._homedir )
+                args.append( homedir )
 
             # be quiet as possible
             args.append( '--quiet' )
@@ -284,97 +484,462 @@ class GnuPG_Decryptor:
 
             # call subprocess
             process = Popen( args ,stdin=PIPE, stdout=PIPE, stderr=PIPE )
-            decrypted, err = process.communicate( sudoPass.encode() + rawData )
-            retcode = process.returncode
+            try:
+                decrypted, err = process.communicate( sudoPass.encode() + rawData, timeout = self._engine.decryptTimeout )
+                retcode = process.returncode
+            except TimeoutExpired:
+                # e.g. nobody answered pinentry prompt, sudo relays SIGTERM to
+                # gpg running as root, SIGKILL would leave gpg orphaned
+                process.terminate()
+                try:
+                    process.wait( timeout = GnuPG_Decryptor_Engine.TERMINATE_TIMEOUT )
+                except TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                # output is not read, child of stopped process might keep pipes open
+                process.stdout.close()
+                process.stderr.close()
+                err     = b'gpg did not finish in time'
+                retcode = -1
 
             # if decryption failed, try next key
             if ( retcode != 0 ):
                 continue
 
             # get mimeType of data
-            mimeType  = self.mimeResolver.from_buffer( decrypted )
+            mimeType  = self._engine.mimeType( decrypted )
 
             # encode data using base64
             decrypted = b64encode( decrypted )
 
             # split data into blocks
-            blocks    = [ decrypted[ i : i + self.MAX_MESSAGE_SIZE ] for i in range( 0, len( decrypted ), self.MAX_MESSAGE_SIZE ) ]
+            blocks    = [ decrypted[ i : i + self.MAX_MESSAGE_SIZE ] for i in range( 0, len( decrypted ), self.MAX_MESSAGE_SIZE ) ] or [ b'' ]
 
-            # get last block of data
-            lastBlock = blocks.pop()
+            # prepare responses, only last block is marked as last
+            responses = [ { 'messageId' : None, 'success' : 1, 'message' : '', 'type' : 'decryptResponse', 'data' : block.decode(), 'encoding' : 'base64', 'mimeType' : mimeType, 'lastBlock' : 0, 'tabId' : None } for block in blocks ]
+            responses[ -1 ][ 'lastBlock' ] = 1
+            return responses
+        if ( retcode != 0 ):
+            return [ GnuPG_Decryptor.errorResponse( err.decode( errors = 'replace' ) ) ]
+        return [ GnuPG_Decryptor.errorResponse( 'Required key is not present' ) ]
 
-            # prepare response
-            response  = { 'messageId' : messageId, 'success' : 1, 'message' : '', 'type' : 'decryptResponse', 'data' : '', 'encoding' : 'base64', 'mimeType' : mimeType, 'lastBlock' : 0, 'tabId' : tabId }
+    def setKeys( self, message ):
+        """
+        Sets keys stored by background script.
+        """
+        self._keysGeneration += 1
+        self._passwords = message[ 'keys' ]
+        self._homedir   = message[ 'homedir' ] if 'homedir' in message else None
+        self._sudo      = '' if 'sudo' in message and message[ 'sudo' ] else None
 
-            # send all blocks, except last one
-            for block in blocks:
-                response[ 'data' ]  = block.decode()
-                self.send_message( GnuPG_Decryptor.encode_message( response ) )
+    def main( self ):
+        """
+        Serves background script on standard input/output.
+        """
+        self.serve()
+        sys.exit( 0 )
 
-            # send last blocks
-            response[ 'data' ]      = lastBlock.decode()
-            response[ 'lastBlock' ] = 1
-            self.send_message( GnuPG_Decryptor.encode_message( response ) )
-            break
-        if ( retcode != 0 ):
-            errorMessage = 'Unable to decrypt data: ' + err.decode()
-            self.send_message( GnuPG_Decryptor.encode_message( { 'messageId' : messageId, 'success' : 0, 'message' : errorMessage, 'type' : 'decryptResponse', 'data' : '', 'tabId' : tabId } ) )
-        elif ( not keys ):
-            errorMessage = 'Unable to decrypt data: Required key is not present'
-            self.send_message( GnuPG_Decryptor.encode_message( { 'messageId' : messageId, 'success' : 0, 'message' : errorMessage, 'type' : 'decryptResponse', 'data' : '', 'tabId' : tabId } ) )
+    def startEngine( self ):
+        """
+        Creates engine, if messages are going to be processed by this process.
+        Relay connected to daemon does not need it.
+        """
+        if ( self._engine is None ):
+            self._engine = GnuPG_Decryptor_Engine()
 
-    def main( self ):
+    def serve( self ):
         """
-        Reads messages from background scripts and create responses.
+        Reads messages from background scripts and create responses until
+        connection is closed.
         """
-        largeRequests    = dict()
+        self.startEngine()
         # load stored keys
         self.loadKeys()
         while True:
             # read message
-            message      = GnuPG_Decryptor.get_message()
-            errorMessage = str()
-            if ( message[ 'type' ] == 'decryptRequest' and 'tabId' in message ):
-                # message is containts encrypted data
-
-                # ged id of sender
-                tabId = message[ 'tabId' ]
-
-                # decode data
-                if ( message[ 'encoding' ] == 'base64' ):
-                    rawData = b64decode( message[ 'data' ] )
-                elif ( message[ 'encoding' ] == 'ascii' ):
-                    rawData = message[ 'data' ].encode()
-                else:
-                    errorMessage = 'Invalid encoding: ' + message[ 'encoding' ]
-                    self.send_message( GnuPG_Decryptor.encode_message( { 'messageId' : message[ 'messageId' ], 'success' : 0, 'message' : errorMessage, 'type' : 'decryptResponse', 'data' : '', 'tabId' : tabId } ) )
-                    continue
+            message      = self.get_message()
+            if ( message is None ):
+                return
+            self.handleMessage( message )
 
-                # data are split into blocks, join those blocks
-                if ( message[ 'lastBlock' ] == 0 ):
-                    largeRequests[ message[ 'messageId' ] ] = largeRequests[ message[ 'messageId' ] ] + rawData if ( message[ 'messageId' ] in largeRequests ) else rawData
-                    continue
-                elif ( message[ 'messageId' ] in largeRequests ):
-                    rawData = largeRequests[ message[ 'messageId' ] ] + rawData
-                    del( largeRequests[ message[ 'messageId' ] ] )
-
-                # get key, that was used for encryption
-                keys = self.getKeyUidFromData( rawData )
-
-                # use only keys that are available
-                keys = [ key for key in keys if key in self._passwords ]
-                #start_time = time.time()
-                t1 = Thread(target = self.decrypt, args = ( rawData, keys, message[ 'messageId' ], tabId ) )
-                t1.start()
-                # if we have at least one valid key, decrypt data
-            elif ( message[ 'type' ] == 'displayWindow' ):
+    def handleMessage( self, message ):
+        """
+        Processes one message from background script.
+        """
+        largeRequests = self._largeRequests
+        errorMessage  = str()
+        if ( message[ 'type' ] == 'decryptRequest' and 'tabId' in message ):
+            # message is containts encrypted data
+
+            # ged id of sender
+            tabId = message[ 'tabId' ]
+
+            # decode data
+            if ( message[ 'encoding' ] == 'base64' ):
+                rawData = b64decode( message[ 'data' ] )
+            elif ( message[ 'encoding' ] == 'ascii' ):
+                rawData = message[ 'data' ].encode()
+            else:
+                errorMessage = 'Invalid encoding: ' + message[ 'encoding' ]
+                self.send_message( GnuPG_Decryptor.encode_message( { 'messageId' : message[ 'messageId' ], 'success' : 0, 'message' : errorMessage, 'type' : 'decryptResponse', 'data' : '', 'tabId' : tabId } ) )
+                return
+
+            # data are split into blocks, join those blocks
+            if ( message[ 'lastBlock' ] == 0 ):
+                largeRequests[ message[ 'messageId' ] ] = largeRequests[ message[ 'messageId' ] ] + rawData if ( message[ 'messageId' ] in largeRequests ) else rawData
+                return
+            elif ( message[ 'messageId' ] in largeRequests ):
+                rawData = largeRequests[ message[ 'messageId' ] ] + rawData
+                del( largeRequests[ message[ 'messageId' ] ] )
+
+            # decrypt data, identical data are decrypted only once
+            self.decryptRequest( rawData, message[ 'messageId' ], tabId )
+        elif ( message[ 'type' ] == 'displayWindow' ):
+            # User clicked on icon - diplay window
+            self.show()
+        elif ( message[ 'type' ] == 'getKeysResponse' ):
+            # Set new keys
+            self.setKeys( message )
+        elif ( message[ 'type' ] == 'setPasswordsRequest' ):
+            # User confirmed keys in window of relay
+            self.setPasswords( message[ 'config' ] )
+
+class GnuPG_Decryptor_Relay( GnuPG_Decryptor ):
+    """
+    Thin native application, that forwards messages of background script to
+    shared daemon. Only window for user is displayed by relay itself, because
+    daemon has no access to display of the browser.
+    """
+    CONNECT_ATTEMPTS = 50
+    CONNECT_DELAY    = 0.1
+    SPAWN_INTERVAL   = 10
+
+    def __init__( self ):
+        super().__init__()
+        self._daemon      = None
+        self._daemonLock  = Lock()
+        self._restoring   = False
+        self._pending     = dict()
+        self._pendingLock = Lock()
+
+    def connect( self ):
+        """
+        Connects to daemon, starts the daemon if it is not running. Returns
+        False if connection could not be established.
+        """
+        directory = GnuPG_Decryptor_Daemon.runtimeDir()
+        if ( directory is None ):
+            return False
+        path = os.path.join( directory, GnuPG_Decryptor_Daemon.SOCKET_NAME )
+        for attempt in range( GnuPG_Decryptor_Relay.CONNECT_ATTEMPTS ):
+            sock = socket( AF_UNIX, SOCK_STREAM )
+            try:
+                sock.connect( path )
+            except OSError:
+                sock.close()
+                # daemon is not running, start it (again, if previous daemon
+                # was just shutting down)
+                if ( attempt % GnuPG_Decryptor_Relay.SPAWN_INTERVAL == 0 ):
+                    script = os.path.abspath( __file__ )
+                    with open( os.path.join( directory, GnuPG_Decryptor_Daemon.LOG_NAME ), 'ab' ) as log:
+                        Popen( [ sys.executable, script, '--daemon' ], stdin=DEVNULL, stdout=DEVNULL, stderr=log, cwd=os.path.dirname( script ), start_new_session=True )
+                sleep( GnuPG_Decryptor_Relay.CONNECT_DELAY )
+                continue
+            # passwords are sent to daemon, it has to run under the same user
+            if ( not GnuPG_Decryptor_Relay.ownedByUser( sock ) ):
+                sock.close()
+                return False
+            self._daemon = { 'socket' : sock, 'input' : sock.makefile( 'rb' ), 'output' : sock.makefile( 'wb' ) }
+            return True
+        return False
+
+    @staticmethod
+    def ownedByUser( sock ):
+        """
+        Checks that process on the other side of socket runs under current user
+        """
+        credentials = sock.getsockopt( SOL_SOCKET, SO_PEERCRED, calcsize( '3i' ) )
+        _, uid, _ = unpack( '3i', credentials )
+        return uid == os.getuid()
+
+    def forward( self, frame, message = None ):
+        """
+        Forwards encoded message to daemon. Returns False if relay is not
+        connected to daemon.
+        """
+        with self._daemonLock:
+            if ( self._daemon is None ):
+                return False
+            # remember requests, that daemon did not answer yet
+            if ( message is not None and message[ 'type' ] == 'decryptRequest' ):
+                with self._pendingLock:
+                    self._pending[ ( message.get( 'tabId' ), message[ 'messageId' ] ) ] = True
+            try:
+                self._daemon[ 'output' ].write( pack( '=I', len( frame ) ) )
+                self._daemon[ 'output' ].write( frame )
+                self._daemon[ 'output' ].flush()
+            except OSError:
+                # daemon is gone, pump reconnects and answers pending requests
+                pass
+            return True
+
+    def passwordsConfig( self ):
+        """
+        Returns keys, passwords, sudo and homedir settings known by relay in
+        format of confirmed settings.
+        """
+        keys = [ { 'id' : keyId, 'password' : password } for keyId, password in self._passwords.items() ]
+        sudo = { 'use' : 0 if self._sudo    is None else 1, 'password' : self._sudo    or '' }
+        home = { 'use' : 0 if self._homedir is None else 1, 'homedir'  : self._homedir or '' }
+        return { 'keys' : keys, 'sudo' : sudo, 'home' : home }
+
+    def reconnect( self ):
+        """
+        Connects to new daemon after previous one stopped. If it is not
+        possible, relay processes messages itself. Returns True if relay is
+        connected again.
+        """
+        with self._daemonLock:
+            self._daemon[ 'socket' ].close()
+            self._daemon = None
+            connected    = self.connect()
+            if ( connected ):
+                # keys are restored when new daemon asks for them
+                self._restoring = True
+            else:
+                self.startEngine()
+
+        # requests sent to stopped daemon will never be answered
+        with self._pendingLock:
+            pending = list( self._pending )
+            self._pending.clear()
+        for tabId, messageId in pending:
+            response = GnuPG_Decryptor.errorResponse( 'Decryption daemon stopped' )
+            response[ 'messageId' ] = messageId
+            response[ 'tabId' ]     = tabId
+            self.send_message( GnuPG_Decryptor.encode_message( response ) )
+        return connected
+
+    def pump( self ):
+        """
+        Forwards messages from daemon to background script.
+        """
+        while True:
+            with self._daemonLock:
+                daemon = self._daemon
+            try:
+                frame = GnuPG_Decryptor.read_frame( daemon[ 'input' ] )
+            except OSError:
+                frame = None
+            if ( frame is None ):
+                # daemon is gone, background script never reconnects, so relay
+                # has to connect to new daemon or process messages itself
+                if ( not self.reconnect() ):
+                    return
+                continue
+
+            message = loads( frame.decode( "utf-8" ) )
+            if ( message[ 'type' ] == 'getKeysRequest' and self._restoring ):
+                # new daemon gets keys and passwords known by relay, browser
+                # stores only keys without passwords
+                self._restoring = False
+                self.forward( dumps( { 'type' : 'setPasswordsRequest', 'config' : self.passwordsConfig() } ).encode( "utf-8" ) )
+                continue
+            if ( message[ 'type' ] == 'decryptResponse' and ( not message[ 'success' ] or message.get( 'lastBlock' ) ) ):
+                with self._pendingLock:
+                    self._pending.pop( ( message[ 'tabId' ], message[ 'messageId' ] ), None )
+            self.send_message( { 'length' : pack( '=I', len( frame ) ), 'content' : frame } )
+
+    def setPasswords( self, config ):
+        """
+        Sets new keys and passwords in relay and in daemon.
+        """
+        self.loadPasswords( config )
+
+        # daemon notifies background script about changes
+        if ( not self.forward( dumps( { 'type' : 'setPasswordsRequest', 'config' : config } ).encode( "utf-8" ) ) ):
+            self.updateKeys()
+
+    def main( self ):
+        """
+        Forwards messages between background script and daemon. If daemon is
+        not available, messages are processed by relay itself.
+        """
+        if ( self.connect() ):
+            Thread( target = self.pump, daemon = True ).start()
+        else:
+            self.startEngine()
+            self.loadKeys()
+
+        while True:
+            frame = GnuPG_Decryptor.read_frame( self._input )
+            if ( frame is None ):
+                sys.exit( 0 )
+            message = loads( frame.decode( "utf-8" ) )
+            if ( message[ 'type' ] == 'displayWindow' ):
                 # User clicked on icon - diplay window
                 self.show()
+            elif ( not self.forward( frame, message ) ):
+                # daemon is not available, process message locally
+                self.handleMessage( message )
             elif ( message[ 'type' ] == 'getKeysResponse' ):
-                # Set new keys
-                self._passwords = message[ 'keys' ]
-                self._homedir   = message[ 'homedir' ] if 'homedir' in message else None
-                self._sudo      = '' if 'sudo' in message and message[ 'sudo' ] else None
+                # keep keys for window
+                self.setKeys( message )
 
-app = GnuPG_Decryptor()
-app.main()
+class GnuPG_Decryptor_Daemon:
+    """
+    Shared decryption daemon of one user. Every connected relay is served by its
+    own GnuPG_Decryptor session (own keys, passwords and responses), sessions
+    share one GnuPG_Decryptor_Engine.
+    """
+    IDLE_TIMEOUT = 600
+    # Daemon serves all browsers. Decryption without passphrase waits for
+    # pinentry of gpg-agent, so pool is large enough for several pending
+    # prompts and gpg decryption is stopped after DECRYPT_TIMEOUT seconds,
+    # so queued requests of other browsers always proceed.
+    MAX_WORKERS     = 16
+    DECRYPT_TIMEOUT = 120
+    SOCKET_NAME  = 'daemon.sock'
+    LOCK_NAME    = 'daemon.lock'
+    LOG_NAME     = 'daemon.log'
+
+    @staticmethod
+    def runtimeDir():
+        """
+        Returns private directory of daemon (socket, lock and log), or None if
+        the directory is not safe to use.
+        """
+        base = os.environ.get( 'XDG_RUNTIME_DIR' ) or '/tmp'
+        path = os.path.join( base, 'gnupg_decryptor-' + str( os.getuid() ) )
+        try:
+            os.mkdir( path, 0o700 )
+        except FileExistsError:
+            pass
+        except OSError:
+            return None
+
+        # directory must not be a symlink, owned by someone else or accessible by others
+        info = os.lstat( path )
+        if ( not S_ISDIR( info.st_mode ) or info.st_uid != os.getuid() or info.st_mode & 0o077 ):
+            return None
+        return path
+
+    def __init__( self, directory ):
+        self._path        = os.path.join( directory, GnuPG_Decryptor_Daemon.SOCKET_NAME )
+        self._lockPath    = os.path.join( directory, GnuPG_Decryptor_Daemon.LOCK_NAME )
+        self._engine      = GnuPG_Decryptor_Engine( GnuPG_Decryptor_Daemon.MAX_WORKERS, GnuPG_Decryptor_Daemon.DECRYPT_TIMEOUT )
+        self._clients     = 0
+        self._clientsLock = Lock()
+        self._lastDisconnect = monotonic()
+
+    def startClient( self, sock ):
+        """
+        Starts serving of accepted relay.
+        """
+        # counted before thread starts, so idle check never misses the client
+        with self._clientsLock:
+            self._clients += 1
+        sock.setblocking( True )
+        Thread( target = self.serveClient, args = ( sock, ), daemon = True ).start()
+
+    def serveClient( self, sock ):
+        """
+        Serves one relay until it disconnects.
+        """
+        try:
+            session = GnuPG_Decryptor( sock.makefile( 'rb' ), sock.makefile( 'wb' ), self._engine )
+            session.serve()
+        except OSError:
+            pass
+        finally:
+            sock.close()
+            with self._clientsLock:
+                self._clients -= 1
+                self._lastDisconnect = monotonic()
+
+    def idleTime( self ):
+        """
+        Returns seconds remaining until daemon is idle for IDLE_TIMEOUT seconds
+        """
+        with self._clientsLock:
+            if ( self._clients > 0 ):
+                return GnuPG_Decryptor_Daemon.IDLE_TIMEOUT
+            return GnuPG_Decryptor_Daemon.IDLE_TIMEOUT - ( monotonic() - self._lastDisconnect )
+
+    def listen( self ):
+        """
+        Creates listening socket of daemon
+        """
+        if ( os.path.exists( self._path ) ):
+            os.unlink( self._path )
+        server = socket( AF_UNIX, SOCK_STREAM )
+        server.bind( self._path )
+        server.listen()
+        return server
+
+    @staticmethod
+    def drain( server ):
+        """
+        Accepts all relays waiting in backlog of socket
+        """
+        server.setblocking( False )
+        pending = []
+        while True:
+            try:
+                sock, _ = server.accept()
+            except BlockingIOError:
+                return pending
+            pending.append( sock )
+
+    def main( self ):
+        """
+        Accepts relays until there are no clients for IDLE_TIMEOUT seconds.
+        """
+        # only one daemon per socket
+        lockFile = open( self._lockPath, 'w' )
+        try:
+            flock( lockFile, LOCK_EX | LOCK_NB )
+        except OSError:
+            lockFile.close()
+            return
+
+        # socket is accessible only by its owner
+        os.umask( 0o077 )
+        server = self.listen()
+        try:
+            while True:
+                remaining = self.idleTime()
+                if ( remaining <= 0 ):
+                    # no new relay can connect, serve those already in backlog
+                    os.unlink( self._path )
+                    pending = GnuPG_Decryptor_Daemon.drain( server )
+                    server.close()
+                    if ( not pending ):
+                        return
+                    for sock in pending:
+                        self.startClient( sock )
+                    server = self.listen()
+                    continue
+                server.settimeout( remaining )
+                try:
+                    sock, _ = server.accept()
+                except timeout:
+                    continue
+                self.startClient( sock )
+        finally:
+            server.close()
+            # lock is still held, socket can not belong to another daemon
+            if ( os.path.exists( self._path ) ):
+                os.unlink( self._path )
+            lockFile.close()
+
+if ( '--daemon' in sys.argv[ 1: ] ):
+    daemonDir = GnuPG_Decryptor_Daemon.runtimeDir()
+    if ( daemonDir is not None ):
+        GnuPG_Decryptor_Daemon( daemonDir ).main()
+elif ( os.environ.get( 'GNUPG_DECRYPTOR_DAEMON' ) ):
+    app = GnuPG_Decryptor_Relay()
+    app.main()
+else:
+    app = GnuPG_Decryptor()
+    app.main()